@@ -20,10 +20,9 @@ setup(
     license='MIT',
     packages=['socrata2sql'],
     install_requires=[
-        'docopt~=0.6',
-        'progress~=1.4',
+        'orjson>=2.0',
         'sodapy~=1.5',
-        'SQLalchemy~=1.2',
+        'SQLalchemy~=1.4',
         'tabulate~=0.8',
         'geoalchemy2~=0.5',
     ],
@@ -32,5 +31,5 @@ setup(
             'socrata2sql=socrata2sql.cli:main',
         ],
     },
-    python_requires=">=3"
+    python_requires=">=3.7"
 )
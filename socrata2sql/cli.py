@@ -6,7 +6,7 @@ SQL types and loads all rows. The loader supports any database supported by
 SQLalchemy.
 
 Usage:
-  socrata2sql insert <site> <dataset_id> [-d=<database_url>] [-a=<app_token>] [-t=<table_name>]
+  socrata2sql insert <site> <dataset_id> [-d=<database_url>] [-a=<app_token>] [-t=<table_name>] [--no-count]
   socrata2sql ls <site> [-a=<app_token>]
   socrata2sql (-h | --help)
   socrata2sql (-v | --version)
@@ -22,7 +22,11 @@ Options:
   -t=<table_name>    Destiation table in the database. Defaults to a sanitized
                      version of the dataset's name on Socrata.
   -a=<app_token>     App token for the site. Only necessary for high-volume
-                     requests. Default: None
+                     requests. With a token, datasets of up to 100,000 rows
+                     are fetched several pages at a time. Default: None
+  --no-count         Don't count the dataset's rows before loading. Skips a
+                     slow query on large datasets, but pages are always
+                     fetched one at a time.
   -h --help          Show this screen.
   -v --version       Show version.
 
@@ -37,25 +41,14 @@ Examples:
   Load it into a PostgreSQL database called mydb:
   $ socrata2sql insert www.dallasopendata.com 64pp-jeba -d=postgresql:///mydb
 """
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from os import path
+import queue
 import re
-
-from docopt import docopt
-from geoalchemy2.types import Geometry
-from progress.bar import FillingCirclesBar
-from sodapy import Socrata
-from sqlalchemy import Column
-from sqlalchemy import create_engine
-from sqlalchemy.exc import OperationalError
-from sqlalchemy.exc import ProgrammingError
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.types import Boolean
-from sqlalchemy.types import DateTime
-from sqlalchemy.types import Integer
-from sqlalchemy.types import Numeric
-from sqlalchemy.types import Text
-from tabulate import tabulate
+import sys
+import threading
 
 from socrata2sql import __version__
 from socrata2sql.exceptions import CLIError
@@ -64,9 +57,38 @@ from socrata2sql.parsers import parse_geom
 from socrata2sql.parsers import parse_str
 from socrata2sql import ui
 
+# sodapy, SQLAlchemy, GeoAlchemy and tabulate are imported inside the
+# functions that need them, so `--help`, `--version` and `ls` don't pay for
+# loading the database stack.
+
+_NONWORD_RE = re.compile(r'\W')
+
+# Maps Socrata types to functions that return the Python type their SQL
+# column expects from the raw Socrata data. Other types are loaded as-is.
+_COL_PARSERS = {
+    'calendar_date': parse_datetime,
+    'point': parse_geom,
+    'location': parse_geom,
+    'text': parse_str,
+    'url': parse_str,
+}
+
+# OFFSET paging gets slower the deeper it goes, so only datasets up to this
+# size are fetched concurrently
+_CONCURRENT_MAX_ROWS = 100000
+
+_USAGE = __doc__.split('Usage:\n')[1].split('\n\n')[0]
+
 
 def get_sql_col(col_data_type):
     """Map a Socrata column type to a SQLalchemy column class"""
+    from geoalchemy2.types import Geometry
+    from sqlalchemy import Column
+    from sqlalchemy.types import Boolean
+    from sqlalchemy.types import DateTime
+    from sqlalchemy.types import Numeric
+    from sqlalchemy.types import Text
+
     col_mappings = {
         'checkbox': Boolean,
         'url': Text,
@@ -91,7 +113,7 @@ def get_table_name(raw_str):
     'Calls to 9-1-1' becomes 'calls_to_911'
     """
     no_spaces = raw_str.replace(' ', '_')
-    return re.sub(r'\W',  '', no_spaces).lower()
+    return _NONWORD_RE.sub('', no_spaces).lower()
 
 
 def default_db_str(dataset_metadata):
@@ -115,14 +137,20 @@ def get_binding(socrata_client, dataset_id, dataset_metadata, geo, dest):
     This looks at each column type in the Socrata API response and creates a
     SQLAlchemy binding with columns to match. For now it fails loudly if it
     encounters a column type we've yet to map to its SQLAlchemy type."""
+    from sqlalchemy import Column
+    from sqlalchemy.ext.declarative import declarative_base
+    from sqlalchemy.types import Integer
+
     if dest is None:
         table_name = get_table_name(dataset_metadata['name'])
     else:
         table_name = dest
 
+    col_parsers = {}
     record_fields = {
         '__tablename__': table_name,
-        '_pk_': Column(Integer, primary_key=True)
+        '_pk_': Column(Integer, primary_key=True),
+        '_col_parsers_': col_parsers,
     }
 
     ui.header(
@@ -147,6 +175,7 @@ def get_binding(socrata_client, dataset_id, dataset_metadata, geo, dest):
 
         try:
             record_fields[col_name] = get_sql_col(col_type)
+            col_parsers[col_name] = _COL_PARSERS.get(col_type)
         except NotImplementedError as e:
             ui.item('%s' % str(e))
             continue
@@ -154,46 +183,100 @@ def get_binding(socrata_client, dataset_id, dataset_metadata, geo, dest):
     return type('SocrataRecord', (declarative_base(),), record_fields)
 
 
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Configure a new SQLite connection for fast bulk loading
+
+    Write-ahead logging with relaxed syncing avoids an fsync for every
+    committed page while still leaving the database file consistent."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA cache_size=-64000')
+    cursor.close()
+
+
 def get_connection(db_str, dataset_metadata):
     """Get a DB connection from the CLI args and Socrata API metadata
 
     Uess the DB URL passed in by the user to generate a database connection.
     By default, returns a local SQLite database."""
+    from sqlalchemy import create_engine
+    from sqlalchemy import event
+    from sqlalchemy import text
+    from sqlalchemy.exc import OperationalError
+    from sqlalchemy.exc import ProgrammingError
+
     if db_str is not None:
-        engine = create_engine(db_str)
         ui.header('Connecting to database')
     else:
-        default = default_db_str(dataset_metadata)
+        db_str = default_db_str(dataset_metadata)
         ui.header('Connecting to database')
-        engine = create_engine(default)
-        ui.item('Using default SQLite database "%s".' % default)
+        ui.item('Using default SQLite database "%s".' % db_str)
 
-    Session = sessionmaker()
-    Session.configure(bind=engine)
+    # Long loads can outlast server idle timeouts, so check pooled
+    # connections before reuse and replace them every half hour
+    engine = create_engine(db_str, pool_pre_ping=True, pool_recycle=1800)
 
-    session = Session()
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', set_sqlite_pragmas)
 
-    # Check for PostGIS support
+    # Check for PostGIS support. Only PostgreSQL can have it, so don't make a
+    # round trip to ask any other database.
+    geo_enabled = False
     gis_q = 'SELECT PostGIS_version();'
-    try:
-        session.execute(gis_q)
-        geo_enabled = True
-    except OperationalError:
-        geo_enabled = False
-    except ProgrammingError:
-        geo_enabled = False
-    finally:
-        session.commit()
-
-    if geo_enabled:
+    if engine.dialect.name == 'postgresql':
+        try:
+            with engine.connect() as conn:
+                conn.execute(text(gis_q))
+            geo_enabled = True
+        except (OperationalError, ProgrammingError):
+            pass
+
+        if geo_enabled:
+            ui.item(
+                'PostGIS is installed. Geometries on Socrata will be imported '
+                'as PostGIS geoms.'
+            )
+        else:
+            ui.item(
+                'Query "%s" failed. Geometry columns will be skipped.' % gis_q
+            )
+    else:
         ui.item(
-            'PostGIS is installed. Geometries on Socrata will be imported '
-            'as PostGIS geoms.'
+            'PostGIS requires PostgreSQL. Geometry columns will be skipped.'
         )
-    else:
-        ui.item('Query "%s" failed. Geometry columns will be skipped.' % gis_q)
 
-    return engine, session, geo_enabled
+    return engine, geo_enabled
+
+
+def use_fast_json(socrata_client):
+    """Decode the client's API responses with orjson when it's installed
+
+    sodapy parses every page with the standard library's json module, which
+    is a large share of the time spent fetching big pages."""
+    try:
+        import orjson
+    except ImportError:
+        return
+
+    def decode_with_orjson(response, *args, **kwargs):
+        response.json = lambda **kwargs: orjson.loads(response.content)
+
+    socrata_client.session.hooks['response'].append(decode_with_orjson)
+
+
+def get_cached_row_count(dataset_metadata):
+    """Get the row count Socrata caches in a dataset's column metadata
+
+    Returns None if no column has cached counts. The cache can lag behind the
+    dataset, which is fine for get_dataset_concurrently."""
+    for col in dataset_metadata['columns']:
+        cached = col.get('cachedContents', {})
+        if 'non_null' in cached and 'null' in cached:
+            return int(cached['non_null']) + int(cached['null'])
+
+    return None
 
 
 def get_row_count(socrata_client, dataset_id):
@@ -205,84 +288,226 @@ def get_row_count(socrata_client, dataset_id):
     return int(count[0]['count'])
 
 
-def get_dataset(socrata_client, dataset_id, page_size=5000):
-    """Iterate over a datasets pages using the Socrata API"""
-    page_num = 0
+def get_dataset(socrata_client, dataset_id, select_cols, page_size=5000,
+                after_id=None):
+    """Iterate over a datasets pages using the Socrata API
+
+    Only the columns in `select_cols` are requested from the API. Pages are
+    ordered by Socrata's internal row ID and each one starts after the last ID
+    of the previous page, which stays fast deep into large datasets where
+    OFFSET paging slows down. Pass `after_id` to start after a given row."""
+    select = ','.join([':id'] + list(select_cols))
+    last_id = after_id
     more_pages = True
 
     while more_pages:
         api_data = socrata_client.get(
             dataset_id,
+            select=select,
+            where=":id > '%s'" % last_id if last_id is not None else None,
+            order=':id',
             limit=page_size,
-            offset=page_size * page_num,
         )
 
         if len(api_data) < page_size:
             more_pages = False
+        else:
+            last_id = api_data[-1][':id']
 
-        page_num += 1
         yield api_data
 
 
+def get_dataset_concurrently(socrata_client, dataset_id, select_cols, num_rows,
+                             page_size=5000, max_workers=6):
+    """Iterate over a datasets pages, fetching several at once
+
+    Uses the row count to request `max_workers` OFFSET pages in parallel, since
+    each request spends most of its time waiting on the API. Pages are still
+    yielded in order. If the dataset grew after it was counted, the remaining
+    rows are fetched with get_dataset.
+
+    Each OFFSET page makes the API skip over every row before it, so this only
+    beats get_dataset for smaller datasets. Parallel requests also need an app
+    token to avoid throttling."""
+    select = ','.join([':id'] + list(select_cols))
+
+    def fetch(offset):
+        return socrata_client.get(
+            dataset_id,
+            select=select,
+            order=':id',
+            limit=page_size,
+            offset=offset,
+        )
+
+    last_page = None
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for offset in range(0, num_rows, page_size):
+            pending.append(executor.submit(fetch, offset))
+            if len(pending) >= max_workers:
+                last_page = pending.popleft().result()
+                yield last_page
+
+        while pending:
+            last_page = pending.popleft().result()
+            yield last_page
+
+    if last_page is None or len(last_page) == page_size:
+        after_id = last_page[-1][':id'] if last_page else None
+        yield from get_dataset(
+            socrata_client, dataset_id, select_cols, page_size, after_id
+        )
+
+
+def prefetch(pages, maxsize=2):
+    """Iterate over pages that are fetched in a background thread
+
+    Lets the next API request run while the current page is being inserted.
+    At most `maxsize` pages are held in memory at once. Errors raised while
+    fetching are re-raised in the consuming thread."""
+    done = object()
+    pending = queue.Queue(maxsize=maxsize)
+
+    def produce():
+        try:
+            for page in pages:
+                pending.put(page)
+        except Exception as e:
+            pending.put(e)
+        else:
+            pending.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    while True:
+        page = pending.get()
+        if page is done:
+            return
+        if isinstance(page, Exception):
+            raise page
+        yield page
+
+
 def list_datasets(socrata_client, domain):
     """List all datasets on a portal using the Socrata API"""
     all_metadata = socrata_client.datasets(domains=[domain], only=['dataset'])
 
-    key_fields = []
-    for dataset in all_metadata:
-        # Simplify the metadata returned by the API
-        key_fields.append({
+    # Simplify the metadata returned by the API
+    key_fields = (
+        {
             'Name': dataset['resource']['name'],
             'Category': dataset['classification'].get('domain_category'),
             'ID': dataset['resource']['id'],
             'URL': dataset['permalink']
-        })
+        }
+        for dataset in all_metadata
+    )
 
-    return sorted(key_fields, key=lambda _: _['Name'].lower())
+    return sorted(key_fields, key=lambda _: _['Name'].casefold())
 
 
 def parse_row(row, binding):
-    """Parse API data into the Python types our binding expects"""
-    parsers = {
-        # This maps SQLAlchemy types (key) to functions that return their
-        # expected Python type from the raw Socrata data.
-        DateTime: parse_datetime,
-        Geometry: parse_geom,
-        Text: parse_str,
-    }
+    """Parse API data into the Python types our binding expects
 
+    Socrata leaves null fields out of its rows, but every row in a bulk INSERT
+    needs the same keys, so missing columns are filled in with None. Columns
+    we skipped when creating the binding are skipped here too."""
     parsed = {}
-    for col_name, col_val in row.items():
-        binding_columns = binding.__mapper__.columns
+    for col_name, parser in binding._col_parsers_.items():
+        col_val = row.get(col_name)
+        if parser is None or col_val is None:
+            parsed[col_name] = col_val
+        else:
+            parsed[col_name] = parser(col_val)
 
-        if col_name not in binding_columns:
-            # We skipped this column when creating the binding; skip it now too
-            continue
+    return parsed
 
-        mapper_col_type = type(binding_columns[col_name].type)
 
-        if mapper_col_type in parsers:
-            parsed[col_name] = parsers[mapper_col_type](col_val)
-        else:
-            parsed[col_name] = col_val
+def parse_args(argv):
+    """Parse command line arguments into a docopt-style dict
 
-    return parsed
+    The module docstring is the help text; argparse only does the parsing."""
+    if not argv:
+        print('Usage:\n%s' % _USAGE)
+        sys.exit(1)
+    if '-h' in argv or '--help' in argv:
+        print(__doc__.strip())
+        sys.exit(0)
+    if argv[0] in ('-v', '--version'):
+        print(__version__)
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(
+        prog='socrata2sql', usage='\n' + _USAGE, add_help=False
+    )
+    commands = parser.add_subparsers(dest='command')
+
+    insert = commands.add_parser(
+        'insert', prog='socrata2sql insert', usage='\n' + _USAGE,
+        add_help=False,
+    )
+    insert.add_argument('site')
+    insert.add_argument('dataset_id')
+    insert.add_argument('-d')
+    insert.add_argument('-a')
+    insert.add_argument('-t')
+    insert.add_argument('--no-count', action='store_true')
+
+    ls = commands.add_parser(
+        'ls', prog='socrata2sql ls', usage='\n' + _USAGE, add_help=False
+    )
+    ls.add_argument('site')
+    ls.add_argument('-a')
+
+    args = parser.parse_args(argv)
+
+    return {
+        'insert': args.command == 'insert',
+        'ls': args.command == 'ls',
+        '<site>': args.site,
+        '<dataset_id>': getattr(args, 'dataset_id', None),
+        '-d': getattr(args, 'd', None),
+        '-a': args.a,
+        '-t': getattr(args, 't', None),
+        '--no-count': getattr(args, 'no_count', False),
+    }
 
 
 def main():
-    arguments = docopt(__doc__, version=__version__)
+    arguments = parse_args(sys.argv[1:])
+
+    from sodapy import Socrata
 
     client = Socrata(arguments['<site>'], arguments['-a'])
+    use_fast_json(client)
 
     try:
         if arguments['ls']:
+            from tabulate import tabulate
+
             datasets = list_datasets(client, arguments['<site>'])
             print(tabulate(datasets, headers='keys', tablefmt='psql'))
         elif arguments['insert']:
+            from sqlalchemy.exc import ProgrammingError
+
             dataset_id = arguments['<dataset_id>']
             metadata = client.get_metadata(dataset_id)
 
-            engine, session, geo = get_connection(arguments['-d'], metadata)
+            # Use Socrata's cached row count if it has one. Otherwise, count
+            # the rows while the destination table is set up.
+            num_rows = None
+            counting = None
+            if not arguments['--no-count']:
+                num_rows = get_cached_row_count(metadata)
+                if num_rows is None:
+                    counter = ThreadPoolExecutor(max_workers=1)
+                    counting = counter.submit(
+                        get_row_count, client, dataset_id
+                    )
+                    counter.shutdown(wait=False)
+
+            engine, geo = get_connection(arguments['-d'], metadata)
             Binding = get_binding(
                 client, dataset_id, metadata, geo, arguments['-t']
             )
@@ -300,27 +525,41 @@ def main():
                     )
                 raise CLIError('Error creating destination table: %s' % str(e))
 
-            num_rows = get_row_count(client, dataset_id)
-            bar = FillingCirclesBar('  ▶ Loading from API', max=num_rows)
-
-            # Iterate the dataset and INSERT each page
-            for page in get_dataset(client, dataset_id):
-                to_insert = []
-                for row in page:
-                    to_insert.append(Binding(**parse_row(row, Binding)))
-
-                session.add_all(to_insert)
+            if counting is not None:
+                num_rows = counting.result()
+            bar = ui.ProgressBar('  ▶ Loading from API', max=num_rows)
+
+            # Iterate the dataset and INSERT each page. Rows go straight to
+            # the table as dicts (no ORM instances) and each page is
+            # committed in its own transaction to keep memory bounded. Pages
+            # are fetched in the background while the previous one inserts.
+            select_cols = [
+                col.name for col in Binding.__table__.columns
+                if col.name != '_pk_'
+            ]
+            concurrent = (
+                arguments['-a'] is not None and
+                num_rows is not None and
+                num_rows <= _CONCURRENT_MAX_ROWS
+            )
+            if concurrent:
+                pages = get_dataset_concurrently(
+                    client, dataset_id, select_cols, num_rows
+                )
+            else:
+                pages = get_dataset(client, dataset_id, select_cols)
+            for page in prefetch(pages):
+                to_insert = [parse_row(row, Binding) for row in page]
+
+                if to_insert:
+                    with engine.begin() as conn:
+                        conn.execute(Binding.__table__.insert(), to_insert)
                 bar.next(n=len(to_insert))
 
             bar.finish()
 
-            ui.item(
-                'Committing rows (this can take a bit for large datasets).'
-            )
-            session.commit()
-
             success = 'Successfully imported %s rows from "%s".' % (
-                num_rows, metadata['name']
+                bar.index, metadata['name']
             )
             ui.header(success, color='\033[92m')
 
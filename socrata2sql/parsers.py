@@ -1,20 +1,32 @@
 from datetime import datetime
-import json
+
+try:
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    import json
+
+    def dumps(obj):
+        # Match orjson's compact output
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
 
 
 def parse_datetime(str_val):
     """Parse a Socrata floating timestamp field into a Python datetime
 
     See https://dev.socrata.com/docs/datatypes/floating_timestamp.html"""
-    if str_val == '':
+    if not str_val:
         return None
 
     try:
-        # Socrata >=2.1
-        return datetime.strptime(str_val, "%Y-%m-%dT%H:%M:%S.%f")
+        # Handles both Socrata >=2.1 (with milliseconds) and <2.1 timestamps
+        return datetime.fromisoformat(str_val)
     except ValueError:
-        # Socrata <2.1
-        return datetime.strptime(str_val, "%Y-%m-%dT%H:%M:%S")
+        # Before Python 3.11, fromisoformat only accepts 3 or 6 digit
+        # fractional seconds
+        return datetime.strptime(str_val, "%Y-%m-%dT%H:%M:%S.%f")
 
 
 def parse_geom(geo_data):
@@ -26,21 +38,19 @@ def parse_geom(geo_data):
     if geo_data is None:
         return None
 
-    if 'latitude' in geo_data and 'longitude' in geo_data:
-        return 'SRID=4326;POINT(%s %s)' % (
-            geo_data['latitude'],
-            geo_data['longitude'],
-        )
-    elif 'human_address' in geo_data and 'latitude' not in geo_data:
-        return None
+    lat = geo_data.get('latitude')
+    lng = geo_data.get('longitude')
+    if lat is not None and lng is not None:
+        return f'SRID=4326;POINT({lat} {lng})'
 
-    if geo_data['type'] == 'Point':
-        return 'SRID=4326;POINT(%s %s)' % (
-            geo_data['coordinates'][0],
-            geo_data['coordinates'][1],
-        )
+    if geo_data.get('type') == 'Point':
+        coords = geo_data['coordinates']
+        return f'SRID=4326;POINT({coords[0]} {coords[1]})'
+
+    if 'human_address' in geo_data:
+        return None
 
-    raise NotImplementedError('%s are not yet supported' % geo_data['type'])
+    raise NotImplementedError(f"{geo_data.get('type')} are not yet supported")
 
 
 def parse_str(raw_str):
@@ -48,6 +58,6 @@ def parse_str(raw_str):
         if 'url' in raw_str:
             return raw_str['url']
 
-        return json.dumps(raw_str)
+        return dumps(raw_str)
 
     return raw_str
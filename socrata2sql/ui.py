@@ -1,6 +1,40 @@
+import sys
+
+
 def header(header_str, color=''):
     print('\n\033[1m%s%s\033[0m' % (color, header_str))
 
 
 def item(item_str):
     print('  ▶ %s' % item_str)
+
+
+class ProgressBar:
+    """Console counter for rows loaded so far
+
+    Only draws when stderr is a terminal, so redirected output stays clean."""
+    def __init__(self, message, max=None):
+        self.message = message
+        self.max = max
+        self.index = 0
+        self.enabled = sys.stderr.isatty()
+
+    def update(self):
+        if not self.enabled:
+            return
+
+        if self.max is None:
+            progress = '%s' % self.index
+        else:
+            progress = '%s/%s' % (self.index, self.max)
+        sys.stderr.write('\r%s: %s' % (self.message, progress))
+        sys.stderr.flush()
+
+    def next(self, n=1):
+        self.index += n
+        self.update()
+
+    def finish(self):
+        if self.enabled:
+            sys.stderr.write('\n')
+            sys.stderr.flush()
@@ -1,12 +1,26 @@
 #! /usr/bin/env python
 from datetime import datetime
+from os import path
+from tempfile import TemporaryDirectory
 import unittest
+from unittest.mock import MagicMock
 from unittest.mock import patch
 
+from socrata2sql.cli import get_binding
+from socrata2sql.cli import get_cached_row_count
+from socrata2sql.cli import get_connection
+from socrata2sql.cli import get_dataset
+from socrata2sql.cli import get_dataset_concurrently
 from socrata2sql.cli import get_table_name
+from socrata2sql.cli import list_datasets
+from socrata2sql.cli import parse_args
+from socrata2sql.cli import parse_row
+from socrata2sql.cli import prefetch
+from socrata2sql.cli import use_fast_json
 from socrata2sql.parsers import parse_datetime
 from socrata2sql.parsers import parse_geom
 from socrata2sql.parsers import parse_str
+from socrata2sql import __version__
 from socrata2sql import ui
 
 
@@ -30,6 +44,13 @@ class DateTimeParserTestCase(unittest.TestCase):
             datetime(2014, 10, 13, 10, 5)
         )
 
+    def test_fractional_seconds(self):
+        """Should keep fractional seconds of any precision"""
+        self.assertEqual(
+            parse_datetime('2014-10-13T10:05:00.5'),
+            datetime(2014, 10, 13, 10, 5, 0, 500000)
+        )
+
 
 class GeomParserTestCase(unittest.TestCase):
     """Tests for parser for Socrata Location and Point fields"""
@@ -71,7 +92,7 @@ class StrParserTestCase(unittest.TestCase):
         """Should serialize complex datatypes to JSON"""
         self.assertEqual(
             parse_str({'x': 'y'}),
-            '{"x": "y"}'
+            '{"x":"y"}'
         )
 
     def test_str(self):
@@ -92,11 +113,272 @@ class UiTestCase(unittest.TestCase):
         ui.item('item')
         patched_print.assert_called_once_with('  ▶ item')
 
+    @patch('socrata2sql.ui.sys.stderr')
+    def test_progress_bar(self, patched_stderr, patched_print):
+        """Should write the running row count to a terminal"""
+        patched_stderr.isatty.return_value = True
+        bar = ui.ProgressBar('Loading', max=10)
+        bar.next(n=4)
+        bar.finish()
+        patched_stderr.write.assert_any_call('\rLoading: 4/10')
+
+    @patch('socrata2sql.ui.sys.stderr')
+    def test_progress_bar_no_tty(self, patched_stderr, patched_print):
+        """Should write nothing when stderr isn't a terminal"""
+        patched_stderr.isatty.return_value = False
+        bar = ui.ProgressBar('Loading', max=10)
+        bar.next(n=4)
+        bar.finish()
+        patched_stderr.write.assert_not_called()
+
+
+class ArgsTestCase(unittest.TestCase):
+    """Tests for command line argument parsing"""
+    def test_insert(self):
+        """Should parse insert commands, including -d=<value> options"""
+        arguments = parse_args([
+            'insert', 'www.dallasopendata.com', '64pp-jeba',
+            '-d=postgresql:///mydb', '-t', 'checks',
+        ])
+        self.assertTrue(arguments['insert'])
+        self.assertFalse(arguments['ls'])
+        self.assertEqual(arguments['<site>'], 'www.dallasopendata.com')
+        self.assertEqual(arguments['<dataset_id>'], '64pp-jeba')
+        self.assertEqual(arguments['-d'], 'postgresql:///mydb')
+        self.assertEqual(arguments['-t'], 'checks')
+        self.assertIsNone(arguments['-a'])
+        self.assertFalse(arguments['--no-count'])
+
+    def test_no_count(self):
+        """Should parse the --no-count flag for insert commands"""
+        arguments = parse_args([
+            'insert', 'www.dallasopendata.com', '64pp-jeba', '--no-count'
+        ])
+        self.assertTrue(arguments['--no-count'])
+
+    def test_ls(self):
+        """Should parse ls commands"""
+        arguments = parse_args(['ls', 'www.dallasopendata.com', '-a', 'tkn'])
+        self.assertTrue(arguments['ls'])
+        self.assertEqual(arguments['<site>'], 'www.dallasopendata.com')
+        self.assertEqual(arguments['-a'], 'tkn')
+        self.assertIsNone(arguments['-d'])
+
+    @patch('sys.stderr')
+    def test_missing_argument(self, patched_stderr):
+        """Should name the subcommand when reporting missing arguments"""
+        with self.assertRaises(SystemExit):
+            parse_args(['insert', 'www.dallasopendata.com'])
+        output = ''.join(c[0][0] for c in patched_stderr.write.call_args_list)
+        self.assertIn('socrata2sql insert: error:', output)
+
+    @patch('socrata2sql.cli.print')
+    def test_version(self, patched_print):
+        """Should print the version and exit"""
+        with self.assertRaises(SystemExit):
+            parse_args(['--version'])
+        patched_print.assert_called_once_with(__version__)
+
+
+class GetDatasetTestCase(unittest.TestCase):
+    """Tests for paging through a dataset with the Socrata API"""
+    def test_pages(self):
+        """Should page by row ID until a short page comes back"""
+        client = MagicMock()
+        client.get.side_effect = [
+            [{':id': 'row-1', 'a': 1}, {':id': 'row-2', 'a': 2}],
+            [{':id': 'row-3', 'a': 3}],
+        ]
+
+        pages = list(get_dataset(client, 'abcd-1234', ['a', 'b'], page_size=2))
+
+        self.assertEqual(len(pages), 2)
+        first, second = [call[1] for call in client.get.call_args_list]
+        self.assertEqual(first['select'], ':id,a,b')
+        self.assertEqual(first['order'], ':id')
+        self.assertIsNone(first['where'])
+        self.assertEqual(second['where'], ":id > 'row-2'")
+
+    def test_concurrent_pages(self):
+        """Should fetch counted pages by offset and yield them in order"""
+        rows = [{':id': 'row-%s' % i, 'a': i} for i in range(5)]
+
+        def get(dataset_id, select, order, limit, offset):
+            return rows[offset:offset + limit]
+
+        client = MagicMock()
+        client.get.side_effect = get
+
+        pages = list(get_dataset_concurrently(
+            client, 'abcd-1234', ['a'], 5, page_size=2, max_workers=2
+        ))
+
+        self.assertEqual(pages, [rows[0:2], rows[2:4], rows[4:5]])
+        self.assertEqual(client.get.call_count, 3)
+
+    def test_concurrent_pages_grown(self):
+        """Should fetch rows added after counting by row ID"""
+        client = MagicMock()
+        client.get.side_effect = [
+            [{':id': 'row-1', 'a': 1}, {':id': 'row-2', 'a': 2}],
+            [{':id': 'row-3', 'a': 3}],
+        ]
+
+        pages = list(get_dataset_concurrently(
+            client, 'abcd-1234', ['a'], 2, page_size=2
+        ))
+
+        self.assertEqual(len(pages), 2)
+        self.assertEqual(
+            client.get.call_args_list[1][1]['where'], ":id > 'row-2'"
+        )
+
+
+class FastJsonTestCase(unittest.TestCase):
+    """Tests for decoding API responses with orjson"""
+    def test_use_fast_json(self):
+        """Should decode the client's responses with orjson"""
+        from requests import Response
+        from sodapy import Socrata
+
+        client = Socrata('www.dallasopendata.com', None)
+        use_fast_json(client)
+
+        response = Response()
+        response._content = b'[{"a": "\\u00e9"}]'
+        for hook in client.session.hooks['response']:
+            hook(response)
+
+        self.assertEqual(response.json(), [{'a': 'é'}])
+        client.close()
+
+
+class PrefetchTestCase(unittest.TestCase):
+    """Tests for fetching dataset pages in a background thread"""
+    def test_order(self):
+        """Should yield every page in its original order"""
+        pages = [[{'x': i}] for i in range(10)]
+        self.assertEqual(list(prefetch(iter(pages))), pages)
+
+    def test_error(self):
+        """Should re-raise errors from the fetching thread"""
+        def pages():
+            yield [{'x': 1}]
+            raise ValueError('API error')
+
+        fetched = prefetch(pages())
+        self.assertEqual(next(fetched), [{'x': 1}])
+        with self.assertRaises(ValueError):
+            next(fetched)
+
+
+class ListDatasetsTestCase(unittest.TestCase):
+    def test_sorted(self):
+        """Should list datasets sorted by name, ignoring case"""
+        client = MagicMock()
+        client.datasets.return_value = [{
+            'resource': {'name': name, 'id': name},
+            'classification': {},
+            'permalink': 'https://www.dallasopendata.com/d/%s' % name,
+        } for name in ('b', 'A', 'c')]
+
+        datasets = list_datasets(client, 'www.dallasopendata.com')
+
+        self.assertEqual([_['Name'] for _ in datasets], ['A', 'b', 'c'])
+        self.assertIsNone(datasets[0]['Category'])
+
 
 class DbTestCase(unittest.TestCase):
     def test_get_table_name(self):
         self.assertEqual(get_table_name('Calls to 9-1-1'), 'calls_to_911')
 
+    def test_get_cached_row_count(self):
+        """Should add up null and non-null counts from column metadata"""
+        self.assertEqual(get_cached_row_count({'columns': [
+            {'fieldName': 'a'},
+            {'fieldName': 'b', 'cachedContents': {'non_null': '8', 'null': 2}},
+        ]}), 10)
+        self.assertIsNone(get_cached_row_count({'columns': [
+            {'fieldName': 'a'},
+        ]}))
+
+    @patch('socrata2sql.ui.print')
+    def test_get_connection_sqlite(self, patched_print):
+        """Should skip geometries and set bulk-load PRAGMAs on SQLite"""
+        from sqlalchemy import text
+
+        with TemporaryDirectory() as tmp_dir:
+            db_str = 'sqlite:///%s' % path.join(tmp_dir, 'test.sqlite')
+            engine, geo_enabled = get_connection(db_str, {'name': 'Test'})
+
+            self.assertIs(geo_enabled, False)
+            with engine.connect() as conn:
+                journal_mode = conn.execute(
+                    text('PRAGMA journal_mode')
+                ).scalar()
+            self.assertEqual(journal_mode, 'wal')
+            engine.dispose()
+
+    @patch('socrata2sql.ui.print')
+    def test_get_binding_twice(self, patched_print):
+        """Should build independent bindings for the same table name"""
+        metadata = {'name': 'Checks', 'columns': [
+            {'fieldName': 'vendor', 'dataTypeName': 'text'},
+        ]}
+        first = get_binding(None, 'abcd-1234', metadata, False, 'twice')
+        second = get_binding(None, 'abcd-1234', metadata, False, 'twice')
+        self.assertIsNot(first.__table__, second.__table__)
+
+    @patch('socrata2sql.ui.print')
+    def test_parse_row(self, patched_print):
+        """Should parse each column by its type and drop unmapped columns"""
+        metadata = {'name': 'Checks', 'columns': [
+            {'fieldName': 'vendor', 'dataTypeName': 'text'},
+            {'fieldName': 'amount', 'dataTypeName': 'number'},
+            {'fieldName': 'paid', 'dataTypeName': 'calendar_date'},
+            {'fieldName': 'location', 'dataTypeName': 'location'},
+        ]}
+        binding = get_binding(None, 'abcd-1234', metadata, False, None)
+
+        self.assertEqual(parse_row({
+            'vendor': {'x': 'y'},
+            'amount': '1.5',
+            'paid': '2014-10-13T10:05:00.000',
+            'location': {'human_address': '100 Main St'},
+        }, binding), {
+            'vendor': '{"x":"y"}',
+            'amount': '1.5',
+            'paid': datetime(2014, 10, 13, 10, 5),
+        })
+
+    @patch('socrata2sql.ui.print')
+    def test_insert_missing_fields(self, patched_print):
+        """Should store nulls for fields Socrata left out of some rows"""
+        from sqlalchemy import create_engine
+
+        metadata = {'name': 'Checks', 'columns': [
+            {'fieldName': 'a', 'dataTypeName': 'text'},
+            {'fieldName': 'b', 'dataTypeName': 'number'},
+        ]}
+        binding = get_binding(None, 'abcd-1234', metadata, False, 'sparse')
+        engine = create_engine('sqlite://')
+        binding.__table__.create(engine)
+
+        page = [{'a': 'y'}, {'a': 'x', 'b': '1'}, {'b': '2'}]
+        with engine.begin() as conn:
+            conn.execute(
+                binding.__table__.insert(),
+                [parse_row(row, binding) for row in page]
+            )
+            stored = conn.execute(
+                binding.__table__.select().order_by(binding.__table__.c._pk_)
+            ).fetchall()
+
+        self.assertEqual(
+            [(row.a, row.b) for row in stored],
+            [('y', None), ('x', 1), (None, 2)]
+        )
+
 
 if __name__ == '__main__':
     unittest.main()